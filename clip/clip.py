@@ -1,12 +1,15 @@
 from typing import Tuple
 
+import mlx.core as mx
 from image_processor import CLIPImageProcessor
 from model import CLIPModel
 from tokenizer import CLIPTokenizer
 
 
-def load(model_dir: str) -> Tuple[CLIPModel, CLIPTokenizer, CLIPImageProcessor]:
-    model = CLIPModel.from_pretrained(model_dir)
+def load(
+    model_dir: str, dtype: mx.Dtype = mx.float32
+) -> Tuple[CLIPModel, CLIPTokenizer, CLIPImageProcessor]:
+    model = CLIPModel.from_pretrained(model_dir, dtype)
     tokenizer = CLIPTokenizer.from_pretrained(model_dir)
     img_processor = CLIPImageProcessor.from_pretrained(model_dir)
     return model, tokenizer, img_processor
@@ -1,13 +1,18 @@
 # Copyright © 2023-2024 Apple Inc.
 
 import argparse
+import copy
+import json
 import shutil
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, Tuple
 
 import mlx.core as mx
+import mlx.nn as nn
 import torch
 from huggingface_hub import snapshot_download
+from mlx.utils import tree_flatten, tree_unflatten
+from model import CLIPModel
 
 
 def get_model_path(path_or_hf_repo: str) -> Path:
@@ -70,6 +75,28 @@ def should_keep_weight(key: str):
     return not ("position_ids" in key)
 
 
+def quantize(
+    weights: Dict[str, mx.array], config: Dict, q_group_size: int, q_bits: int
+) -> Tuple[Dict[str, mx.array], Dict]:
+    quantized_config = copy.deepcopy(config)
+
+    # Load the model:
+    model = CLIPModel.from_config(config)
+    model.update(tree_unflatten(list(weights.items())))
+
+    # Quantize the model:
+    nn.QuantizedLinear.quantize_module(model, q_group_size, q_bits)
+
+    # Update the config:
+    quantized_config["quantization"] = {
+        "group_size": q_group_size,
+        "bits": q_bits,
+    }
+    quantized_weights = dict(tree_flatten(model.parameters()))
+
+    return quantized_weights, quantized_config
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Download and Convert (OpenAI) CLIP weights to MLX"
@@ -86,6 +113,24 @@ if __name__ == "__main__":
         default="mlx_model",
         help="Path to save the MLX model.",
     )
+    parser.add_argument(
+        "-q",
+        "--quantize",
+        help="Generate a quantized model.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--q-group-size",
+        help="Group size for quantization.",
+        type=int,
+        default=64,
+    )
+    parser.add_argument(
+        "--q-bits",
+        help="Bits per weight for quantization.",
+        type=int,
+        default=8,
+    )
 
     args = parser.parse_args()
 
@@ -98,9 +143,21 @@ if __name__ == "__main__":
     print("[INFO] Converting")
     mlx_weights = dict(map_weights(k, v) for (k, v) in torch_weights.items())
     mlx_weights = {k: v for (k, v) in mlx_weights.items() if should_keep_weight(k)}
+    mlx_weights = CLIPModel.sanitize(mlx_weights)
+    with open(torch_path / "config.json", "r") as fid:
+        config = json.load(fid)
+
+    if args.quantize:
+        print("[INFO] Quantizing")
+        mlx_weights, config = quantize(
+            mlx_weights, config, args.q_group_size, args.q_bits
+        )
+
     print("[INFO] Saving")
     mx.savez(str(mlx_path / "weights.npz"), **mlx_weights)
-    for fn in ["config.json", "merges.txt", "vocab.json", "preprocessor_config.json"]:
+    with open(mlx_path / "config.json", "w") as fid:
+        json.dump(config, fid, indent=4)
+    for fn in ["merges.txt", "vocab.json", "preprocessor_config.json"]:
         shutil.copyfile(
             str(torch_path / f"{fn}"),
             str(mlx_path / f"{fn}"),
@@ -1,15 +1,16 @@
 # Copyright © 2023-2024 Apple Inc.
 
 import json
+import math
 from dataclasses import dataclass
+from functools import partial
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 import mlx.core as mx
 import mlx.nn as nn
-from mlx.core import linalg as LA
 from mlx.nn.losses import cross_entropy
-from mlx.utils import tree_flatten
+from mlx.utils import tree_unflatten
 
 
 @dataclass
@@ -61,6 +62,7 @@ class CLIPConfig:
     projection_dim: int
 
 
+@partial(mx.compile, shapeless=True)
 def quick_gelu(x: mx.array) -> mx.array:
     """
     A fast GELU approximation https://github.com/hendrycks/GELUs
@@ -68,6 +70,55 @@ def quick_gelu(x: mx.array) -> mx.array:
     return x * mx.sigmoid(1.702 * x)
 
 
+@mx.compile
+def embed_tokens(
+    ids: mx.array,
+    position_ids: mx.array,
+    token_embedding: mx.array,
+    position_embedding: mx.array,
+) -> mx.array:
+    """
+    Gather the token and positional embeddings and add them in a single
+    compiled graph.
+    """
+    return token_embedding[ids] + position_embedding[position_ids]
+
+
+@mx.compile
+def embed_patches(
+    patch_embeddings: mx.array,
+    class_embedding: mx.array,
+    position_embedding: mx.array,
+) -> mx.array:
+    """
+    Prepend the <CLS> embedding to the patch embeddings and add the positional
+    embeddings in a single compiled graph.
+    """
+    batch_size, _, embed_dim = patch_embeddings.shape
+    # Add the <CLS> positional encoding once, before broadcasting over the
+    # batch, so the broadcast view goes straight into the concatenation
+    cls_embeddings = class_embedding + position_embedding[0]
+    # [batch_size, 1, embed_dim]
+    cls_embeddings = mx.broadcast_to(cls_embeddings, (batch_size, 1, embed_dim))
+    patch_embeddings = patch_embeddings + position_embedding[1:]
+    # [batch_size, num_patches + 1, embed_dim]
+    return mx.concatenate((cls_embeddings, patch_embeddings), axis=1)
+
+
+def layer_norm(x: mx.array, norm: nn.LayerNorm) -> mx.array:
+    """
+    Apply the parameters of an nn.LayerNorm with the fused layer norm kernel.
+    """
+    return mx.fast.layer_norm(x, norm.weight, norm.bias, norm.eps)
+
+
+def inverse_norm(x: mx.array) -> mx.array:
+    """
+    The reciprocal of the L2 norm of x along the last axis.
+    """
+    return mx.rsqrt(mx.sum(mx.square(x), axis=-1, keepdims=True))
+
+
 def clip_loss(logits: mx.array) -> mx.array:
     N, M = logits.shape
     caption_loss = cross_entropy(logits, mx.arange(N), reduction="mean")
@@ -75,6 +126,33 @@ def clip_loss(logits: mx.array) -> mx.array:
     return (caption_loss + image_loss) / 2.0
 
 
+class CLIPAttention(nn.Module):
+    """Multi-head self-attention using the fused attention kernel."""
+
+    def __init__(self, dims: int, num_heads: int):
+        super().__init__()
+        self.num_heads = num_heads
+        self.scale = math.sqrt(1 / (dims // num_heads))
+        # Fused query, key and value projections
+        self.qkv_proj = nn.Linear(dims, 3 * dims, bias=True)
+        self.out_proj = nn.Linear(dims, dims, bias=True)
+
+    def __call__(self, x: mx.array, mask: Optional[mx.array] = None) -> mx.array:
+        B, L, _ = x.shape
+        queries, keys, values = mx.split(self.qkv_proj(x), 3, axis=-1)
+
+        # [batch_size, num_heads, seq_len, head_dim]
+        queries = queries.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
+        keys = keys.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
+        values = values.reshape(B, L, self.num_heads, -1).transpose(0, 2, 1, 3)
+
+        output = mx.fast.scaled_dot_product_attention(
+            queries, keys, values, scale=self.scale, mask=mask
+        )
+        output = output.transpose(0, 2, 1, 3).reshape(B, L, -1)
+        return self.out_proj(output)
+
+
 class CLIPEncoderLayer(nn.TransformerEncoderLayer):
     """The transformer encoder layer from CLIP."""
 
@@ -87,7 +165,17 @@ class CLIPEncoderLayer(nn.TransformerEncoderLayer):
             norm_first=True,
         )
         # Add biases to the attention projections
-        self.attention = nn.MultiHeadAttention(hidden_dim, num_heads, bias=True)
+        self.attention = CLIPAttention(hidden_dim, num_heads)
+
+    def __call__(self, x: mx.array, mask: Optional[mx.array] = None) -> mx.array:
+        y = layer_norm(x, self.ln1)
+        y = self.attention(y, mask)
+        x = x + y
+        y = layer_norm(x, self.ln2)
+        y = self.linear1(y)
+        y = self.activation(y)
+        y = self.linear2(y)
+        return x + y
 
 
 class CLIPTextModel(nn.Module):
@@ -97,9 +185,11 @@ class CLIPTextModel(nn.Module):
         super().__init__()
 
         self.token_embedding = nn.Embedding(config.vocab_size, config.hidden_size)
-        self.position_embedding = mx.zeros(
-            (config.max_position_embeddings, config.hidden_size)
+        self.position_embedding = nn.Embedding(
+            config.max_position_embeddings, config.hidden_size
         )
+        self._position_ids = mx.arange(config.max_position_embeddings)
+        self.max_position_embeddings = config.max_position_embeddings
         self.layers = [
             CLIPEncoderLayer(
                 config.hidden_size, config.intermediate_size, config.num_attention_heads
@@ -107,21 +197,58 @@ class CLIPTextModel(nn.Module):
             for _ in range(config.num_hidden_layers)
         ]
         self.final_layer_norm = nn.LayerNorm(config.hidden_size)
+        # Compile the transformer stack so the graph is traced once per input
+        # shape and the per-layer elementwise ops can be fused
+        self._encode = mx.compile(self._run_layers, inputs=self.layers)
+        # Additive causal masks keyed by (sequence length, dtype)
+        self._mask_cache = {}
+
+    def _causal_mask(self, N: int, dtype: mx.Dtype) -> mx.array:
+        key = (N, dtype)
+        if key not in self._mask_cache:
+            # Build the mask in float32 and cast, -1e9 overflows in float16
+            mask = nn.MultiHeadAttention.create_additive_causal_mask(N)
+            self._mask_cache[key] = mask.astype(dtype)
+        return self._mask_cache[key]
+
+    def _run_layers(self, x: mx.array, mask: mx.array) -> mx.array:
+        for l in self.layers:
+            x = l(x, mask)
+        return x
 
     def _embed(self, x: mx.array) -> mx.array:
-        embeddings = self.token_embedding(x)
-        embeddings += self.position_embedding[: x.shape[1]]
-        return embeddings
+        return embed_tokens(
+            x,
+            self._position_ids[: x.shape[1]],
+            self.token_embedding.weight,
+            self.position_embedding.weight,
+        )
 
-    def __call__(self, x: mx.array) -> CLIPTextOutput:
+    def __call__(self, x: mx.array, pad_to_max: bool = True) -> CLIPTextOutput:
+        """
+        Encode a batch of token ids.
+
+        By default inputs are padded to the maximum number of positions, so
+        the compiled encoder only sees one sequence length. The causal mask
+        keeps the padding from affecting the real tokens and the outputs are
+        trimmed back to the input length. For short or variable-length inputs,
+        pass ``pad_to_max=False`` to encode at the input length instead; this
+        does less work per call but traces the encoder once per length.
+        """
         B, N = x.shape
         eot_tokens = mx.argmax(x, axis=-1)
+        if pad_to_max and N < self.max_position_embeddings:
+            x = mx.pad(x, [(0, 0), (0, self.max_position_embeddings - N)])
         x = self._embed(x)
-        mask = nn.MultiHeadAttention.create_additive_causal_mask(N, x.dtype)
-        for l in self.layers:
-            x = l(x, mask)
-        last_hidden_state = self.final_layer_norm(x)
-        pooler_output = last_hidden_state[mx.arange(B), eot_tokens]
+        mask = self._causal_mask(x.shape[1], x.dtype)
+        x = self._encode(x, mask)
+        last_hidden_state = layer_norm(x[:, :N], self.final_layer_norm)
+        # Gather the hidden state at the <EOT> token of each sequence
+        eot_tokens = mx.broadcast_to(
+            eot_tokens[:, None, None], (B, 1, last_hidden_state.shape[-1])
+        )
+        pooler_output = mx.take_along_axis(last_hidden_state, eot_tokens, axis=1)
+        pooler_output = pooler_output.squeeze(1)
 
         return CLIPTextOutput(
             pooler_output=pooler_output, last_hidden_state=last_hidden_state
@@ -135,6 +262,8 @@ class CLIPVisionModel(nn.Module):
         super().__init__()
 
         self.class_embedding = mx.zeros((config.hidden_size,))
+        self.patch_size = config.patch_size
+        # Holds the patchifying convolution kernel, applied as a matmul in _embed
         self.patch_embedding = nn.Conv2d(
             in_channels=config.num_channels,
             out_channels=config.hidden_size,
@@ -153,35 +282,39 @@ class CLIPVisionModel(nn.Module):
             for _ in range(config.num_hidden_layers)
         ]
         self.post_layernorm = nn.LayerNorm(config.hidden_size)
+        self._encode = mx.compile(self._run_layers, inputs=self.layers)
+
+    def _run_layers(self, x: mx.array) -> mx.array:
+        for l in self.layers:
+            x = l(x, mask=None)
+        return x
 
     def _embed(self, x: mx.array) -> mx.array:
-        batch_size = x.shape[0]
-        # Patchify using conv:
-        # [batch_size, sqrt(num_patches), sqrt(num_patches), embed_dim]
-        patch_embeddings = self.patch_embedding(x)
+        batch_size, height, width, num_channels = x.shape
+        p = self.patch_size
+        # The patches do not overlap, so the patchifying convolution is a
+        # single matmul over the flattened patches:
+        # [batch_size, num_patches, patch_size * patch_size * num_channels]
+        x = x.reshape(batch_size, height // p, p, width // p, p, num_channels)
+        x = x.transpose(0, 1, 3, 2, 4, 5).reshape(batch_size, -1, p * p * num_channels)
+        # [embed_dim, patch_size * patch_size * num_channels]
+        weight = self.patch_embedding.weight
+        weight = weight.reshape(weight.shape[0], -1)
         # [batch_size, num_patches, embed_dim]
-        patch_embeddings = mx.flatten(patch_embeddings, start_axis=1, end_axis=2)
-        embed_dim = patch_embeddings.shape[-1]
-        # Prepend <CLS> embeddings
-        # [batch_size, 1, embed_dim]
-        cls_embeddings = mx.broadcast_to(
-            self.class_embedding, (batch_size, 1, embed_dim)
+        patch_embeddings = x @ weight.T
+        # Prepend <CLS> embeddings and add positional encoding
+        return embed_patches(
+            patch_embeddings, self.class_embedding, self.position_embedding
         )
-        # [batch_size, num_patches + 1, embed_dim]
-        embeddings = mx.concatenate((cls_embeddings, patch_embeddings), axis=1)
-        # Add positional encoding
-        embeddings += self.position_embedding
-        return embeddings
 
     def __call__(self, x: mx.array) -> CLIPVisionOutput:
+        x = x.astype(self.patch_embedding.weight.dtype)
         x = self._embed(x)
-        x = self.pre_layernorm(x)
-
-        for l in self.layers:
-            x = l(x, mask=None)
+        x = layer_norm(x, self.pre_layernorm)
+        x = self._encode(x)
 
         # Extract <CLS> token embedding
-        pooler_output = self.post_layernorm(x[:, 0, :])
+        pooler_output = layer_norm(x[:, 0, :], self.post_layernorm)
         return CLIPVisionOutput(pooler_output=pooler_output, last_hidden_state=x)
 
 
@@ -212,16 +345,18 @@ class CLIPModel(nn.Module):
     ) -> CLIPModelOutput:
         if input_ids is not None:
             text_model_output = self.text_model(input_ids)
-            text_embeds = self.text_projection(text_model_output.pooler_output)
-            text_embeds = text_embeds / LA.norm(text_embeds, axis=-1, keepdims=True)
+            text_features = self.text_projection(text_model_output.pooler_output)
+            text_inv_norm = inverse_norm(text_features)
+            text_embeds = text_features * text_inv_norm
         else:
             text_embeds = None
             text_model_output = None
 
         if pixel_values is not None:
             vision_model_output = self.vision_model(pixel_values)
-            image_embeds = self.visual_projection(vision_model_output.pooler_output)
-            image_embeds = image_embeds / LA.norm(image_embeds, axis=-1, keepdims=True)
+            image_features = self.visual_projection(vision_model_output.pooler_output)
+            image_inv_norm = inverse_norm(image_features)
+            image_embeds = image_features * image_inv_norm
         else:
             image_embeds = None
             vision_model_output = None
@@ -230,8 +365,11 @@ class CLIPModel(nn.Module):
             raise ValueError("Must provide text and image inputs to compute loss.")
 
         if return_loss:
+            # Fold the normalization into the scale of the similarity matrix
+            # rather than multiplying the normalized embeddings
             logit_scale = mx.exp(self.logit_scale)
-            logits = (text_embeds @ image_embeds.T) * logit_scale
+            logit_scale = logit_scale * text_inv_norm * image_inv_norm.T
+            logits = (text_features @ image_features.T) * logit_scale
             loss = clip_loss(logits)
         else:
             loss = None
@@ -245,12 +383,28 @@ class CLIPModel(nn.Module):
         )
 
     @staticmethod
-    def from_pretrained(path: str):
+    def from_pretrained(path: str, dtype: mx.Dtype = mx.float32):
         path = Path(path)
 
         with open(path / "config.json", "r") as fid:
             config = json.load(fid)
+        quantization = config.get("quantization", None)
+
+        model = CLIPModel.from_config(config)
+        if quantization is not None:
+            nn.QuantizedLinear.quantize_module(model, **quantization)
+        weights = CLIPModel.sanitize(mx.load(str(path / "weights.npz")))
+        # Cast everything except the packed quantized weights
+        weights = {
+            k: v if v.dtype == mx.uint32 else v.astype(dtype)
+            for k, v in weights.items()
+        }
+        model.update(tree_unflatten(list(weights.items())))
+        return model
 
+    @staticmethod
+    def from_config(config: Dict[str, Any]):
+        """Build an uninitialized model from a Hugging Face CLIP config."""
         text_config = config["text_config"]
         text_config = CLIPTextConfig(
             num_hidden_layers=text_config["num_hidden_layers"],
@@ -278,6 +432,27 @@ class CLIPModel(nn.Module):
             vision_config=vision_config,
             projection_dim=config["projection_dim"],
         )
-        model = CLIPModel(config)
-        model.load_weights(str(path / "weights.npz"))
-        return model
+        return CLIPModel(config)
+
+    @staticmethod
+    def sanitize(weights: Dict[str, mx.array]) -> Dict[str, mx.array]:
+        """
+        Map weights with separate query, key and value projections onto the
+        fused attention projection and move the text positional embeddings
+        into their embedding layer.
+        """
+        sanitized_weights = {}
+        for k, v in weights.items():
+            if k == "text_model.position_embedding":
+                k = "text_model.position_embedding.weight"
+            elif "attention.query_proj." in k:
+                parts = [
+                    weights[k.replace("query_proj.", f"{p}_proj.")]
+                    for p in ("query", "key", "value")
+                ]
+                k = k.replace("query_proj.", "qkv_proj.")
+                v = mx.concatenate(parts, axis=0)
+            elif "attention.key_proj." in k or "attention.value_proj." in k:
+                continue
+            sanitized_weights[k] = v
+        return sanitized_weights
@@ -1,11 +1,17 @@
+import json
+import shutil
+import tempfile
 import unittest
+from pathlib import Path
 
+import convert
 import mlx.core as mx
 import model
 import numpy as np
 import torch
 import transformers
 from image_processor import CLIPImageProcessor
+from mlx.utils import tree_flatten
 from PIL import Image
 from tokenizer import CLIPTokenizer
 from transformers import AutoTokenizer
@@ -49,7 +55,17 @@ class TestCLIP(unittest.TestCase):
         self.assertTrue(mx.allclose(mx_data, hf_data, atol=1e-5))
 
     def test_text_tokenizer(self):
-        texts = ["a photo of a cat", "a photo of a dog"]
+        texts = [
+            "a photo of a cat",
+            "a photo of a dog",
+            # Long words with repeated subwords exercise the merge order
+            "bananarama mississippi abracadabra",
+            "supercalifragilisticexpialidocious antidisestablishmentarianism",
+            "hahahahahaha lalalala zzzzzzzz",
+            "!!!???... --- ***",
+            "12345 3.14159 2024-01-31",
+            "isn't it a dog's life?!",
+        ]
         for txt in texts:
             self.assertTrue(
                 np.array_equal(
@@ -58,6 +74,34 @@ class TestCLIP(unittest.TestCase):
                 ),
             )
 
+    def test_text_tokenizer_batch(self):
+        texts = ["a photo of a cat", "a photo of a very happy dog"]
+        mx_ids, mx_mask = self.mx_tokenizer.tokenize_batch(texts)
+        hf_tokens = self.hf_tokenizer(
+            texts, padding="max_length", max_length=77, return_tensors="np"
+        )
+        self.assertTrue(np.array_equal(mx_ids, hf_tokens["input_ids"]))
+        self.assertTrue(np.array_equal(mx_mask, hf_tokens["attention_mask"]))
+        self.assertEqual(self.mx_tokenizer.tokenize([]).size, 0)
+
+    def test_text_tokenizer_cache(self):
+        texts = ["a photo of a cat", "a photo of a dog"]
+        expected = self.mx_tokenizer(texts)
+        with tempfile.TemporaryDirectory() as tmp:
+            for fn in ["vocab.json", "merges.txt"]:
+                shutil.copyfile(Path(MLX_PATH) / fn, Path(tmp) / fn)
+            self.mx_tokenizer.save_cache(tmp)
+            tokenizer = CLIPTokenizer.from_pretrained(tmp)
+            self.assertEqual(tokenizer._cache, self.mx_tokenizer._cache)
+            self.assertTrue(mx.array_equal(tokenizer(texts), expected))
+
+            # A cache that does not hold token ids is ignored
+            with open(Path(tmp) / "bpe_cache.json", "w") as f:
+                json.dump({"photo": ["photo</w>"]}, f)
+            tokenizer = CLIPTokenizer.from_pretrained(tmp)
+            self.assertNotIn("photo", tokenizer._cache)
+            self.assertTrue(mx.array_equal(tokenizer(texts), expected))
+
     def test_text_encoder(self):
         texts = ["a photo of a cat", "a photo of a dog"]
         # Tokenize
@@ -76,6 +120,17 @@ class TestCLIP(unittest.TestCase):
             np.allclose(out.pooler_output, expected_pooler_output, atol=1e-5)
         )
 
+    def test_text_encoder_unpadded(self):
+        tokens = self.mx_tokenizer(["a photo of a cat", "a photo of a dog"])
+        padded_out = self.mx_clip.text_model(tokens)
+        out = self.mx_clip.text_model(tokens, pad_to_max=False)
+        self.assertTrue(
+            mx.allclose(out.last_hidden_state, padded_out.last_hidden_state, atol=1e-5)
+        )
+        self.assertTrue(
+            mx.allclose(out.pooler_output, padded_out.pooler_output, atol=1e-5)
+        )
+
     def test_vision_encoder(self):
         # Load and process test image
         x = self.hf_image_proc(
@@ -103,6 +158,81 @@ class TestCLIP(unittest.TestCase):
             ),
         )
 
+    def test_half_precision(self):
+        texts = ["a photo of a cat", "a photo of a dog"]
+        tokens = self.mx_tokenizer(texts)
+        image = self.mx_image_proc([Image.open("assets/dog.jpeg")])
+        expected_text = self.mx_clip.text_model(tokens).pooler_output
+        expected_image = self.mx_clip.vision_model(image).pooler_output
+        for dtype in [mx.float16, mx.bfloat16]:
+            clip = model.CLIPModel.from_pretrained(MLX_PATH, dtype=dtype)
+            text_out = clip.text_model(tokens).pooler_output
+            image_out = clip.vision_model(image).pooler_output
+            self.assertEqual(text_out.dtype, dtype)
+            self.assertEqual(image_out.dtype, dtype)
+            for out, expected in [
+                (text_out, expected_text),
+                (image_out, expected_image),
+            ]:
+                out = out.astype(mx.float32)
+                self.assertTrue(np.isfinite(np.array(out)).all())
+                self.assertTrue(mx.allclose(out, expected, rtol=5e-2, atol=5e-2))
+
+    def test_quantized_model(self):
+        tokens = self.mx_tokenizer(["a photo of a cat", "a photo of a dog"])
+        images = self.mx_image_proc(
+            [Image.open("assets/cat.jpeg"), Image.open("assets/dog.jpeg")]
+        )
+        expected_out = self.mx_clip(input_ids=tokens, pixel_values=images)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "mlx_model"
+            shutil.copytree(MLX_PATH, path)
+            # Read from the original model, mx.load is lazy and the copy's
+            # weights.npz is overwritten below
+            weights = mx.load(str(Path(MLX_PATH) / "weights.npz"))
+            weights = model.CLIPModel.sanitize(weights)
+            with open(path / "config.json", "r") as fid:
+                config = json.load(fid)
+            weights, config = convert.quantize(
+                weights, config, q_group_size=64, q_bits=8
+            )
+            mx.savez(str(path / "weights.npz"), **weights)
+            with open(path / "config.json", "w") as fid:
+                json.dump(config, fid)
+            clip = model.CLIPModel.from_pretrained(path)
+            # Load the weights before the temporary directory is removed
+            mx.eval(clip.parameters())
+
+        out = clip(input_ids=tokens, pixel_values=images)
+        self.assertTrue(
+            mx.allclose(out.text_embeds, expected_out.text_embeds, atol=5e-2)
+        )
+        self.assertTrue(
+            mx.allclose(out.image_embeds, expected_out.image_embeds, atol=5e-2)
+        )
+
+        # Splitting the fused, quantized projections and sanitizing them must
+        # give back the same weights
+        weights = dict(tree_flatten(clip.parameters()))
+        for suffix in ["weight", "scales", "biases"]:
+            key = f"text_model.layers.0.attention.qkv_proj.{suffix}"
+            self.assertIn(key, weights)
+        self.assertEqual(
+            weights["text_model.layers.0.attention.qkv_proj.weight"].dtype, mx.uint32
+        )
+        split_weights = {}
+        for k, v in weights.items():
+            if "qkv_proj." not in k:
+                split_weights[k] = v
+                continue
+            for p, w in zip(["query", "key", "value"], mx.split(v, 3, axis=0)):
+                split_weights[k.replace("qkv_proj.", f"{p}_proj.")] = w
+        sanitized_weights = model.CLIPModel.sanitize(split_weights)
+        self.assertEqual(set(sanitized_weights), set(weights))
+        for k, v in weights.items():
+            self.assertTrue(mx.array_equal(sanitized_weights[k], v))
+
     def test_clip_model(self):
         image_input = self.hf_image_proc(
             images=[Image.open("assets/cat.jpeg"), Image.open("assets/dog.jpeg")],
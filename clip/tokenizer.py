@@ -1,12 +1,16 @@
 # Copyright © 2023-2024 Apple Inc.
 
+import heapq
 import json
 from pathlib import Path
-from typing import Any
+from typing import Any, List, Optional, Tuple
 
 import mlx.core as mx
+import numpy as np
 import regex
 
+_WHITESPACE = regex.compile(r"\s+")
+
 
 class CLIPTokenizer:
     """A simple port of CLIPTokenizer from https://github.com/huggingface/transformers/ ."""
@@ -18,7 +22,7 @@ class CLIPTokenizer:
             r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""",
             regex.IGNORECASE,
         )
-        self._cache = {self.bos: self.bos, self.eos: self.eos}
+        self._cache = {self.bos: [self.bos_token], self.eos: [self.eos_token]}
 
     @property
     def bos(self):
@@ -37,74 +41,129 @@ class CLIPTokenizer:
         return self.vocab[self.eos]
 
     def bpe(self, text):
+        """Split text into byte-pair units and return their token ids."""
         if text in self._cache:
             return self._cache[text]
 
         unigrams = list(text[:-1]) + [text[-1] + "</w>"]
-        unique_bigrams = set(zip(unigrams, unigrams[1:]))
-
-        if not unique_bigrams:
-            return unigrams
 
-        # In every iteration try to merge the two most likely bigrams. If none
-        # was merged we are done.
+        # Repeatedly merge the most likely bigram until no mergeable bigram is
+        # left. Candidates are kept in a heap ordered by rank; entries that no
+        # longer occur in the current split are skipped when popped.
         #
         # Ported from https://github.com/huggingface/transformers/blob/main/src/transformers/models/clip/tokenization_py
-        while unique_bigrams:
-            bigram = min(
-                unique_bigrams, key=lambda pair: self.bpe_ranks.get(pair, float("inf"))
-            )
-            if bigram not in self.bpe_ranks:
-                break
+        heap = [
+            (self.bpe_ranks[bigram], bigram)
+            for bigram in set(zip(unigrams, unigrams[1:]))
+            if bigram in self.bpe_ranks
+        ]
+        heapq.heapify(heap)
+        while heap:
+            _, (first, second) = heapq.heappop(heap)
 
             new_unigrams = []
-            skip = False
-            for a, b in zip(unigrams, unigrams[1:]):
-                if skip:
-                    skip = False
-                    continue
-
-                if (a, b) == bigram:
-                    new_unigrams.append(a + b)
-                    skip = True
-
+            merged = []
+            i = 0
+            while i < len(unigrams):
+                if (
+                    i < len(unigrams) - 1
+                    and unigrams[i] == first
+                    and unigrams[i + 1] == second
+                ):
+                    merged.append(len(new_unigrams))
+                    new_unigrams.append(first + second)
+                    i += 2
                 else:
-                    new_unigrams.append(a)
+                    new_unigrams.append(unigrams[i])
+                    i += 1
 
-            if not skip:
-                new_unigrams.append(b)
+            if not merged:
+                continue
 
+            # Only the bigrams next to a merge site are new
             unigrams = new_unigrams
-            unique_bigrams = set(zip(unigrams, unigrams[1:]))
+            for j in merged:
+                neighbors = []
+                if j > 0:
+                    neighbors.append((unigrams[j - 1], unigrams[j]))
+                if j < len(unigrams) - 1:
+                    neighbors.append((unigrams[j], unigrams[j + 1]))
+                for bigram in neighbors:
+                    if bigram in self.bpe_ranks:
+                        heapq.heappush(heap, (self.bpe_ranks[bigram], bigram))
 
-        self._cache[text] = unigrams
+        ids = [self.vocab[u] for u in unigrams]
+        self._cache[text] = ids
 
-        return unigrams
+        return ids
 
     def __call__(self, *args: Any, **kwargs: Any) -> Any:
         return self.tokenize(*args, **kwargs)
 
     def tokenize(self, text, prepend_bos=True, append_eos=True) -> mx.array:
         if isinstance(text, list):
-            return mx.array([self.tokenize(t, prepend_bos, append_eos) for t in text])
-
+            ids, _ = self.tokenize_batch(
+                text, max_length=None, prepend_bos=prepend_bos, append_eos=append_eos
+            )
+            return ids
+        return mx.array(self._encode(text, prepend_bos, append_eos))
+
+    def tokenize_batch(
+        self,
+        texts: List[str],
+        max_length: Optional[int] = 77,
+        pad_id: Optional[int] = None,
+        prepend_bos: bool = True,
+        append_eos: bool = True,
+    ) -> Tuple[mx.array, mx.array]:
+        """
+        Tokenize a list of strings into a padded batch of token ids and the
+        matching attention mask. Sequences longer than ``max_length`` are
+        truncated. If ``max_length`` is ``None`` the batch is padded to the
+        longest sequence. Like Hugging Face's CLIP tokenizer, the padding
+        defaults to the ``<|endoftext|>`` token.
+        """
+        if pad_id is None:
+            pad_id = self.eos_token
+        encoded = [self._encode(t, prepend_bos, append_eos) for t in texts]
+        if max_length is None:
+            max_length = max((len(ids) for ids in encoded), default=0)
+
+        input_ids = np.full((len(encoded), max_length), pad_id, dtype=np.int32)
+        attention_mask = np.zeros((len(encoded), max_length), dtype=np.int32)
+        for i, ids in enumerate(encoded):
+            if len(ids) > max_length:
+                ids = ids[:max_length]
+                if append_eos:
+                    ids[-1] = self.eos_token
+            input_ids[i, : len(ids)] = ids
+            attention_mask[i, : len(ids)] = 1
+        return mx.array(input_ids), mx.array(attention_mask)
+
+    def _encode(self, text: str, prepend_bos: bool, append_eos: bool) -> List[int]:
         # Lower case, cleanup, and split. Hugging Face does a much,
         # more thorough job here but this should suffice for 95% of
         # cases.
-        clean_text = regex.sub(r"\s+", " ", text.lower())
-        tokens = regex.findall(self.pat, clean_text)
+        clean_text = _WHITESPACE.sub(" ", text.lower())
+        tokens = self.pat.findall(clean_text)
 
-        # Split the tokens according to the byte-pair merge file
-        bpe_tokens = [ti for t in tokens for ti in self.bpe(t)]
-
-        # Map to token ids and return
-        tokens = []
+        # Split the tokens according to the byte-pair merge file and map
+        # them to token ids
+        ids = []
         if prepend_bos:
-            tokens.append(self.bos_token)
-        tokens.extend(self.vocab[t] for t in bpe_tokens)
+            ids.append(self.bos_token)
+        ids.extend(i for t in tokens for i in self.bpe(t))
         if append_eos:
-            tokens.append(self.eos_token)
-        return mx.array(tokens)
+            ids.append(self.eos_token)
+        return ids
+
+    def save_cache(self, path: str):
+        """
+        Save the byte-pair cache to ``bpe_cache.json`` in the directory
+        ``path`` so that ``from_pretrained`` can reload it.
+        """
+        with open(Path(path) / "bpe_cache.json", "w", encoding="utf-8") as f:
+            json.dump(self._cache, f)
 
     @staticmethod
     def from_pretrained(path: str):
@@ -118,4 +177,26 @@ class CLIPTokenizer:
         bpe_merges = [tuple(m.split()) for m in bpe_merges]
         bpe_ranks = dict(map(reversed, enumerate(bpe_merges)))
 
-        return CLIPTokenizer(bpe_ranks, vocab)
+        tokenizer = CLIPTokenizer(bpe_ranks, vocab)
+        if (path / "bpe_cache.json").exists():
+            with open(path / "bpe_cache.json", encoding="utf-8") as f:
+                cache = json.load(f)
+            if _is_valid_cache(cache, vocab):
+                tokenizer._cache.update(cache)
+            else:
+                print("[WARNING] Ignoring invalid bpe_cache.json.")
+        return tokenizer
+
+
+def _is_valid_cache(cache, vocab) -> bool:
+    """Check that a loaded cache maps strings to lists of vocabulary ids."""
+    if not isinstance(cache, dict):
+        return False
+    ids = set(vocab.values())
+    return all(
+        isinstance(text, str)
+        and isinstance(token_ids, list)
+        and len(token_ids) > 0
+        and all(type(i) is int and i in ids for i in token_ids)
+        for text, token_ids in cache.items()
+    )